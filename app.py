@@ -1,79 +1,322 @@
-import io
+from __future__ import annotations
+
+import os
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 import datetime as dt
-
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash
-import pandas as pd
-import requests
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from uuid import uuid4
+import asyncio
+
+from flask import (
+    Flask,
+    flash,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    url_for,
+)
+from werkzeug.exceptions import RequestEntityTooLarge
+import httpx
+
+# pandas/numpy/xlsxwriter тяжёлые (~100 мс и десятки МБ на воркер), поэтому
+# импортируем их внутри функций — только когда действительно обрабатываем файл
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 app = Flask(__name__)
-app.secret_key = "asu_photo_secret_key"  # для flash-сообщений
+app.secret_key = os.environ.get("SECRET_KEY", "asu_photo_secret_key")  # для flash-сообщений и сессии
+MAX_UPLOAD_MB = 50  # файлы больше не принимаем
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
 
 # простой кэш, чтобы не дергать один и тот же URL много раз
 _url_datetime_cache: dict[str, dt.datetime | None] = {}
 
+# постоянный кэш на диске: переживает перезапуск и общий для всех воркеров.
+# Соединение открываем лениво и своё в каждом процессе: при gunicorn --preload
+# соединение, открытое до fork, нельзя делить между воркерами. Кэш необязательный:
+# если файл недоступен (read-only каталог, блокировка), работаем с кэшем в памяти
+CACHE_PATH = os.environ.get(
+    "URL_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "url_cache.sqlite"),
+)
+_cache_conn: sqlite3.Connection | None = None
+_cache_pid: int | None = None
+_cache_lock = threading.Lock()
+# сколько ссылок подставляем в один SELECT ... IN (...) (лимит параметров SQLite)
+_CACHE_QUERY_CHUNK = 500
+
+# в таблице так помечаем ссылки, из которых дату достать не удалось
+_NO_DATETIME = -1
+
+# сколько соединений держим при пакетном резолве (запросы упираются в сеть, а не в CPU)
+URL_MAX_CONNECTIONS = 64
+# из них держим открытыми между запросами (keep-alive, TLS-рукопожатие не повторяем)
+URL_KEEPALIVE_CONNECTIONS = 32
+# и сколько запросов одновременно шлём на один хост, чтобы не получить 429
+URL_PER_HOST_LIMIT = 16
+# повторы после 429 и максимальная пауза между ними (сек)
+URL_RATE_LIMIT_RETRIES = 3
+URL_MAX_RETRY_WAIT = 30
+# повторы при временных ошибках сервера
+URL_SERVER_ERROR_RETRIES = 2
+_SERVER_ERROR_STATUSES = {502, 503, 504}
+# общий лимит на резолв всех ссылок одной загрузки (сек), чтобы запрос не висел
+URL_RESOLVE_DEADLINE = 120
+
+# временная неудача (таймаут, сеть, 429/5xx после всех повторов) — в кэш не пишем,
+# при следующей загрузке ссылка будет запрошена снова
+_TRANSIENT = object()
+
+
+_SAVED_RE = re.compile(r"saved-(\d{8})_(\d{6})")
+
 
 def extract_datetime_from_string(s: str):
     """Ищет в строке шаблон saved-YYYYMMDD_HHMMSS и возвращает datetime или None."""
     if not isinstance(s, str):
         return None
-    match = re.search(r"saved-(\d{8})_(\d{6})", s)
+    return _parse_saved(s)
+
+
+@lru_cache(maxsize=65536)
+def _parse_saved(s: str):
+    match = _SAVED_RE.search(s)
     if not match:
         return None
     date_part = match.group(1)  # YYYYMMDD
     time_part = match.group(2)  # HHMMSS
     try:
-        year = int(date_part[0:4])
-        month = int(date_part[4:6])
-        day = int(date_part[6:8])
-        hour = int(time_part[0:2])
-        minute = int(time_part[2:4])
-        second = int(time_part[4:6])
-        return dt.datetime(year, month, day, hour, minute, second)
+        return dt.datetime.strptime(f"{date_part}{time_part}", "%Y%m%d%H%M%S")
     except ValueError:
         return None
 
 
-def get_datetime_from_url(raw_url: str):
-    """
-    Принимает URL из Excel (вида .../get-photo-url/45964825/),
-    делает HTTP-запрос, берёт финальный URL с saved-YYYYMMDD_HHMMSS
-    и вытаскивает дату/время.
-    """
+def extract_datetimes(values: pd.Series) -> pd.Series:
+    """Векторный вариант extract_datetime_from_string для целого столбца (NaT, где даты нет)."""
+    import pandas as pd
+
+    parts = values.astype("string").str.extract(_SAVED_RE)
+    return pd.to_datetime(parts[0] + parts[1], format="%Y%m%d%H%M%S", errors="coerce")
+
+
+def normalize_url(raw_url):
+    """Очищает ссылку из Excel: пробелы и ведущий '@'. Для пустых значений — None."""
     if not isinstance(raw_url, str) or not raw_url.strip():
         return None
-
     # иногда ссылку копируют с ведущим '@'
-    url = raw_url.strip().lstrip("@")
+    return raw_url.strip().lstrip("@")
+
+
+def _retry_after_seconds(resp: httpx.Response, attempt: int):
+    """Сколько ждать после 429: по заголовку Retry-After, иначе экспоненциально."""
+    value = resp.headers.get("Retry-After", "").strip()
+    if value.isdigit():
+        return min(int(value), URL_MAX_RETRY_WAIT)
+    if value:
+        # вторая допустимая форма — HTTP-дата
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            when = None
+        if when is not None:
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=dt.timezone.utc)
+            delay = (when - dt.datetime.now(dt.timezone.utc)).total_seconds()
+            return min(max(delay, 0), URL_MAX_RETRY_WAIT)
+    return min(0.5 * 2**attempt, URL_MAX_RETRY_WAIT)
+
+
+async def _fetch_final_url(client: httpx.AsyncClient, url: str):
+    """Проходит по редиректам и возвращает последний ответ.
+
+    Нужен только адрес после редиректов, поэтому сначала пробуем HEAD — тело фото
+    не скачивается. Если сервер HEAD не поддерживает (405), делаем GET
+    и закрываем ответ, не читая тело — но только если дата ещё не видна в адресе.
+    """
+    resp = await client.head(url, follow_redirects=True)
+    if resp.status_code == 405 and extract_datetime_from_string(str(resp.url)) is None:
+        async with client.stream("GET", url, follow_redirects=True) as resp:
+            pass
+    return resp
 
-    if url in _url_datetime_cache:
-        return _url_datetime_cache[url]
 
+async def _resolve_async(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, url: str):
+    """Делает HTTP-запрос по уже очищенному URL и достаёт дату из финального адреса.
+
+    Если дата уже есть в адресе после редиректов, статус ответа не важен
+    (хост с фото может ответить на HEAD и 429, и 503). Иначе: одновременных
+    запросов к хосту не больше, чем позволяет semaphore (на время пауз он
+    отпускается); на 429 ждём Retry-After, на 502/503/504 — короткую паузу,
+    и пробуем ещё раз. Если так и не получилось — _TRANSIENT.
+    """
     try:
-        resp = requests.get(url, allow_redirects=True, timeout=15)
-        final_url = resp.url
-        dt_obj = extract_datetime_from_string(final_url)
-    except Exception:
-        dt_obj = None
+        for attempt in range(max(URL_RATE_LIMIT_RETRIES, URL_SERVER_ERROR_RETRIES) + 1):
+            async with semaphore:
+                resp = await _fetch_final_url(client, url)
+            dt_obj = extract_datetime_from_string(str(resp.url))
+            if dt_obj is not None:
+                return dt_obj
+            if resp.status_code == 429 and attempt < URL_RATE_LIMIT_RETRIES:
+                wait = _retry_after_seconds(resp, attempt)
+            elif resp.status_code in _SERVER_ERROR_STATUSES and attempt < URL_SERVER_ERROR_RETRIES:
+                wait = 0.2 * 2**attempt
+            else:
+                break
+            await asyncio.sleep(wait)
+    except (httpx.TimeoutException, httpx.NetworkError, httpx.ProtocolError) as exc:
+        app.logger.warning("Не удалось получить ссылку %s: %s", url, exc)
+        return _TRANSIENT
+    except Exception as exc:
+        app.logger.warning("Некорректная ссылка %s: %s", url, exc)
+        return None
+    if resp.status_code == 429 or resp.status_code in _SERVER_ERROR_STATUSES:
+        app.logger.warning("Сервер ответил %s, ссылка пропущена: %s", resp.status_code, url)
+        return _TRANSIENT
+    return None
 
-    _url_datetime_cache[url] = dt_obj
-    return dt_obj
 
+async def resolve_all(urls, transport: httpx.AsyncBaseTransport | None = None):
+    """Резолвит все ссылки одновременно.
+
+    По HTTP/2 запросы к одному хосту идут через пару соединений,
+    а не через отдельное соединение на каждую ссылку. Чтобы не упереться
+    в rate limit, на каждый хост заводим свой семафор. Всё, что не успело
+    за URL_RESOLVE_DEADLINE, отменяется и считается временной неудачей.
+    transport можно подменить (например, httpx.MockTransport в тестах).
+    """
+    semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def host_semaphore(url: str):
+        try:
+            host = httpx.URL(url).host
+        except Exception:
+            host = ""  # битая ссылка всё равно упадёт в _resolve_async
+        if host not in semaphores:
+            semaphores[host] = asyncio.Semaphore(URL_PER_HOST_LIMIT)
+        return semaphores[host]
+
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        transport=transport,
+        limits=httpx.Limits(
+            max_connections=URL_MAX_CONNECTIONS,
+            max_keepalive_connections=URL_KEEPALIVE_CONNECTIONS,
+        ),
+    ) as client:
+        tasks = [
+            asyncio.create_task(_resolve_async(client, host_semaphore(u), u)) for u in urls
+        ]
+        _done, pending = await asyncio.wait(tasks, timeout=URL_RESOLVE_DEADLINE)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            app.logger.warning("Не успели получить %s ссылок за отведённое время", len(pending))
+        return [_TRANSIENT if task.cancelled() else task.result() for task in tasks]
+
+
+def _ts_to_datetime(ts: int):
+    if ts == _NO_DATETIME:
+        return None
+    return dt.datetime.fromtimestamp(ts, dt.timezone.utc).replace(tzinfo=None)
+
+
+def _datetime_to_ts(dt_obj):
+    if dt_obj is None:
+        return _NO_DATETIME
+    return int(dt_obj.replace(tzinfo=dt.timezone.utc).timestamp())
 
-def format_interval(minutes: int):
-    """minutes -> строка '45 мин' или '1 ч 25 мин' или 'ошибка'."""
-    if minutes is None:
-        return ""
-    if minutes < 0:
-        return "ошибка"
-    if minutes < 60:
-        return f"{minutes} мин"
-    hours = minutes // 60
-    mins = minutes % 60
-    if mins == 0:
-        return f"{hours} ч"
-    return f"{hours} ч {mins} мин"
+
+def _cache_connection():
+    """Соединение с дисковым кэшем для текущего процесса (вызывать под _cache_lock)."""
+    global _cache_conn, _cache_pid
+    if _cache_conn is None or _cache_pid != os.getpid():
+        _cache_conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _cache_conn.execute("CREATE TABLE IF NOT EXISTS url_dt (url TEXT PRIMARY KEY, ts INTEGER)")
+        _cache_conn.commit()
+        _cache_pid = os.getpid()
+    return _cache_conn
+
+
+def cache_get_many(urls):
+    """Возвращает {url: datetime | None} для ссылок, которые уже есть в дисковом кэше."""
+    urls = list(urls)
+    found = {}
+    try:
+        with _cache_lock:
+            conn = _cache_connection()
+            for start in range(0, len(urls), _CACHE_QUERY_CHUNK):
+                chunk = urls[start : start + _CACHE_QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT url, ts FROM url_dt WHERE url IN ({placeholders})", chunk
+                )
+                for url, ts in rows:
+                    found[url] = _ts_to_datetime(ts)
+    except sqlite3.Error as exc:
+        app.logger.warning("Дисковый кэш ссылок недоступен (%s): %s", CACHE_PATH, exc)
+        return {}
+    return found
+
+
+def cache_put_many(items):
+    """Сохраняет пары (url, datetime | None) в дисковый кэш одной транзакцией."""
+    rows = [(url, _datetime_to_ts(dt_obj)) for url, dt_obj in items]
+    if not rows:
+        return
+    try:
+        with _cache_lock:
+            conn = _cache_connection()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO url_dt (url, ts) VALUES (?, ?)", rows)
+    except sqlite3.Error as exc:
+        # результаты уже лежат в кэше в памяти, загрузку из-за этого не роняем
+        app.logger.warning("Не удалось сохранить ссылки в дисковый кэш (%s): %s", CACHE_PATH, exc)
+
+
+def resolve_urls(raw_urls):
+    """Одновременно резолвит все ещё не закэшированные ссылки и складывает их в кэш."""
+    urls = {normalize_url(u) for u in raw_urls}
+    urls.discard(None)
+    missing = [u for u in urls if u not in _url_datetime_cache]
+    if not missing:
+        return
+
+    from_disk = cache_get_many(missing)
+    _url_datetime_cache.update(from_disk)
+    pending = [u for u in missing if u not in from_disk]
+    if not pending:
+        return
+
+    results = asyncio.run(resolve_all(pending))
+    resolved = [(u, r) for u, r in zip(pending, results) if r is not _TRANSIENT]
+    _url_datetime_cache.update(resolved)
+    cache_put_many(resolved)
+
+
+def format_intervals(minutes: pd.Series):
+    """Series минут (Int64) -> строки '45 мин' / '1 ч' / '1 ч 25 мин', 'ошибка' или ''."""
+    import numpy as np
+
+    missing = minutes.isna().to_numpy()
+    m = minutes.fillna(0).astype("int64")
+    hours = (m // 60).astype(str)
+    mins = (m % 60).astype(str)
+    return np.select(
+        [missing, (m < 0).to_numpy(), (m < 60).to_numpy(), (m % 60 == 0).to_numpy()],
+        ["", "ошибка", (m.astype(str) + " мин").to_numpy(), (hours + " ч").to_numpy()],
+        default=(hours + " ч " + mins + " мин").to_numpy(),
+    )
 
 
 def detect_photo_columns(df: pd.DataFrame):
@@ -82,12 +325,18 @@ def detect_photo_columns(df: pd.DataFrame):
     1) Сначала пробуем по точным названиям 'Фото ДО' и 'Фото ПОСЛЕ' (как в вашем файле).
     2) Если не нашли — резервный вариант: любые два текстовых столбца с 'saved-' в значениях.
     """
+    import pandas as pd
+
     # 1. По заголовкам
-    cols_lower = {str(c).strip().lower(): c for c in df.columns}
-    before_col = cols_lower.get("фото до")
-    after_col = cols_lower.get("фото после")
-    if before_col is not None and after_col is not None:
-        return before_col, after_col
+    before_col = after_col = None
+    for col in df.columns:
+        name = str(col).strip().lower()
+        if name == "фото до" and before_col is None:
+            before_col = col
+        elif name == "фото после" and after_col is None:
+            after_col = col
+        if before_col is not None and after_col is not None:
+            return before_col, after_col
 
     # 2. Старый вариант — по содержимому saved-
     candidate_cols = []
@@ -95,9 +344,11 @@ def detect_photo_columns(df: pd.DataFrame):
         series = df[col]
         if not pd.api.types.is_object_dtype(series):
             continue
-        contains_saved = series.astype(str).str.contains("saved-", na=False)
-        if contains_saved.any():
-            candidate_cols.append(col)
+        # до первого совпадения, без прохода по всему столбцу
+        for value in series:
+            if isinstance(value, str) and "saved-" in value:
+                candidate_cols.append(col)
+                break
         if len(candidate_cols) >= 2:
             break
     if len(candidate_cols) < 2:
@@ -106,45 +357,38 @@ def detect_photo_columns(df: pd.DataFrame):
 
 
 def process_dataframe(df: pd.DataFrame):
-    """Обрабатывает DataFrame и возвращает (df_processed, before_col, after_col, preview_html)."""
+    """Обрабатывает DataFrame и возвращает (df_processed, before_col, after_col, preview, intervals)."""
+    import pandas as pd
+
     before_col, after_col = detect_photo_columns(df)
     if before_col is None or after_col is None:
         raise ValueError("Не найдены два столбца со ссылками на фото (столбцы 'Фото ДО' и 'Фото ПОСЛЕ').")
 
-    df = df.copy()
-
-    before_dates = []
-    after_dates = []
-    interval_minutes_raw = []
-    interval_strs = []
-
-    for _, row in df.iterrows():
-        before_val = row.get(before_col)
-        after_val = row.get(after_col)
-
-        dt_before = get_datetime_from_url(before_val)
-        dt_after = get_datetime_from_url(after_val)
-
-        before_dates.append(dt_before)
-        after_dates.append(dt_after)
-
-        if dt_before is None or dt_after is None:
-            interval_minutes_raw.append(None)
-            interval_strs.append("")
-        else:
-            delta = dt_after - dt_before
-            minutes = int(delta.total_seconds() // 60)
-            if minutes < 0:
-                interval_minutes_raw.append(None)
-                interval_strs.append("ошибка")
-            else:
-                interval_minutes_raw.append(minutes)
-                interval_strs.append(format_interval(minutes))
-
-    df["Дата_время_до"] = before_dates
-    df["Дата_время_после"] = after_dates
-    df["Интервал_мин"] = interval_strs
-    df["interval_minutes_raw"] = interval_minutes_raw
+    before_urls = df[before_col].map(normalize_url)
+    after_urls = df[after_col].map(normalize_url)
+
+    # Часть ссылок уже содержит saved-YYYYMMDD_HHMMSS — для них HTTP не нужен
+    before_direct = extract_datetimes(before_urls)
+    after_direct = extract_datetimes(after_urls)
+
+    # Остальные одним махом резолвим по уникальным ссылкам (одно фото часто стоит
+    # в нескольких строках), дальше — только поиск по кэшу
+    to_resolve = pd.concat([before_urls[before_direct.isna()], after_urls[after_direct.isna()]])
+    resolve_urls(pd.unique(to_resolve.dropna()))
+
+    before = before_direct.fillna(pd.to_datetime(before_urls.map(_url_datetime_cache)))
+    after = after_direct.fillna(pd.to_datetime(after_urls.map(_url_datetime_cache)))
+    delta_min = ((after - before).dt.total_seconds() // 60).astype("Int64")
+
+    # assign возвращает новый DataFrame, исходный не трогаем и не копируем заранее
+    df = df.assign(
+        **{
+            "Дата_время_до": before,
+            "Дата_время_после": after,
+            "Интервал_мин": format_intervals(delta_min),
+            "interval_minutes_raw": delta_min.where(delta_min >= 0),
+        }
+    )
 
     # Предпросмотр
     cols_to_show = [
@@ -154,31 +398,135 @@ def process_dataframe(df: pd.DataFrame):
         "Дата_время_после",
         "Интервал_мин",
     ]
-    preview_df = df[cols_to_show + ["interval_minutes_raw"]].head(15).copy()
+    head = df.head(15)
+    interval_list = head["interval_minutes_raw"].tolist()
+
+    # Форматируем даты для предпросмотра (служебную колонку в таблицу не берём)
+    preview_df = head[cols_to_show].assign(
+        **{
+            col: head[col].dt.strftime("%Y-%m-%d %H:%M:%S").fillna("")
+            for col in ["Дата_время_до", "Дата_время_после"]
+        }
+    )
+
+    # Таблицу рисует шаблон, сюда отдаём только заголовки и строки
+    preview = {
+        "columns": cols_to_show,
+        "rows": preview_df.fillna("").to_dict(orient="records"),
+    }
+
+    return df, before_col, after_col, preview, interval_list
 
-    # Форматируем даты для предпросмотра
-    for col in ["Дата_время_до", "Дата_время_после"]:
-        preview_df[col] = preview_df[col].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S") if isinstance(x, dt.datetime) else ""
-        )
 
-    # Отрисуем HTML-таблицу без служебной колонки
-    interval_list = preview_df["interval_minutes_raw"].tolist()
-    preview_df = preview_df.drop(columns=["interval_minutes_raw"])
-    preview_html = preview_df.to_html(
-        classes="table table-striped table-bordered table-sm",
-        index=False,
-        border=0,
-        escape=False,
+def read_excel_file(path: str) -> pd.DataFrame:
+    """Читает .xlsx/.xls через calamine (Rust), при ошибке — штатными движками pandas."""
+    import pandas as pd
+
+    try:
+        return pd.read_excel(path, engine="calamine")
+    except Exception:
+        if path.endswith(".xlsx"):
+            return pd.read_excel(path, engine="openpyxl")
+        return pd.read_excel(path)
+
+
+def write_excel_file(df: pd.DataFrame, path: str):
+    """Пишет DataFrame в .xlsx построчно в режиме constant_memory.
+
+    В этом режиме xlsxwriter сбрасывает каждую строку на диск сразу после записи,
+    но принимает строки только по порядку. pandas пишет ячейки по столбцам,
+    поэтому df.to_excel тут не подходит — строки пишем сами.
+    """
+    import pandas as pd
+    import xlsxwriter
+
+    def excel_value(value):
+        # приводим значение ячейки pandas к типу, который понимает xlsxwriter
+        if pd.api.types.is_scalar(value) and pd.isna(value):
+            return None
+        if isinstance(value, pd.Timestamp):
+            return value.to_pydatetime()
+        if hasattr(value, "item"):  # numpy-скаляры
+            return value.item()
+        return value
+
+    workbook = xlsxwriter.Workbook(
+        path,
+        {
+            "constant_memory": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+            # ссылки пишем обычным текстом: в листе допустимо не больше 65 530
+            # гиперссылок, остальные ячейки xlsxwriter молча пропускает
+            "strings_to_urls": False,
+        },
     )
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, [str(c) for c in df.columns])
+        for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_idx, 0, [excel_value(v) for v in row])
+    finally:
+        workbook.close()
+
 
-    return df, before_col, after_col, preview_html, interval_list
+# обработанные файлы лежат во временной папке как asu_<token>.xlsx;
+# в сессии хранится только token, путь всегда собираем на сервере
+_RESULT_TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+_RESULT_NAME_RE = re.compile(r"^asu_[0-9a-f]{32}\.xlsx$")
+RESULT_MAX_AGE = 24 * 60 * 60  # сек; результаты старше суток удаляем
+
+
+def _result_path(token):
+    """Путь к результату по token из сессии или None, если token некорректный."""
+    if not isinstance(token, str) or not _RESULT_TOKEN_RE.match(token):
+        return None
+    return os.path.join(tempfile.gettempdir(), f"asu_{token}.xlsx")
+
+
+def _remove_file(path):
+    """Удаляет временный файл, если он ещё существует."""
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _cleanup_old_results():
+    """Удаляет результаты, которые так и не скачали за RESULT_MAX_AGE."""
+    tmp_dir = tempfile.gettempdir()
+    now = dt.datetime.now().timestamp()
+    for name in os.listdir(tmp_dir):
+        if not _RESULT_NAME_RE.match(name):
+            continue
+        path = os.path.join(tmp_dir, name)
+        try:
+            if now - os.path.getmtime(path) > RESULT_MAX_AGE:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(_exc):
+    flash(f"Файл слишком большой (максимум {MAX_UPLOAD_MB} МБ).")
+    return redirect(url_for("index"))
+
+
+@lru_cache(maxsize=1)
+def _render_empty_index():
+    """Пустая форма одинакова для всех, поэтому рендерим её один раз."""
+    return render_template("index.html", preview=None, download_url=None)
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "GET":
-        return render_template("index.html", preview_html=None, download_url=None)
+        # с flash-сообщениями и в debug (шаблон может меняться) рендерим заново
+        if "_flashes" in session or app.debug:
+            return render_template("index.html", preview=None, download_url=None)
+        return _render_empty_index()
 
     # POST: загрузка и обработка файла
     uploaded = request.files.get("file")
@@ -191,53 +539,53 @@ def index():
         flash("Поддерживаются только файлы .xlsx и .xls")
         return redirect(url_for("index"))
 
-    try:
-        # Читаем Excel из памяти
-        file_bytes = uploaded.read()
-        buffer = io.BytesIO(file_bytes)
-
-        if filename.lower().endswith(".xlsx"):
-            df = pd.read_excel(buffer, engine="openpyxl")
-        else:
-            df = pd.read_excel(buffer)
+    # Пишем загрузку во временный файл кусками, не держа её целиком в памяти
+    suffix = "." + filename.rsplit(".", 1)[-1].lower()
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        shutil.copyfileobj(uploaded.stream, tmp, 1 << 20)
+        upload_path = tmp.name
 
-        df_processed, before_col, after_col, preview_html, _intervals = process_dataframe(
+    try:
+        df = read_excel_file(upload_path)
+        df_processed, before_col, after_col, preview, _intervals = process_dataframe(
             df
         )
     except Exception as exc:
         flash(f"Ошибка обработки файла: {exc}")
         return redirect(url_for("index"))
+    finally:
+        os.unlink(upload_path)
 
-    # Сохраняем обработанный файл в сессию как байты (в реальном проде — в хранилище)
-    output = io.BytesIO()
-    df_to_save = df_processed.copy()
-    if "interval_minutes_raw" in df_to_save.columns:
-        df_to_save = df_to_save.drop(columns=["interval_minutes_raw"])
-    df_to_save.to_excel(output, index=False, engine="openpyxl")
-    output.seek(0)
+    # Сохраняем обработанный файл во временную папку, token — в сессию пользователя
+    _cleanup_old_results()
+    df_to_save = df_processed.drop(columns=["interval_minutes_raw"], errors="ignore")
+    token = uuid4().hex
+    write_excel_file(df_to_save, _result_path(token))
 
-    # Кладём в глобальный dict по простому ключу (один пользователь за раз)
-    app.config["LAST_PROCESSED_FILE"] = output
-    app.config["LAST_PROCESSED_NAME"] = filename.rsplit(".", 1)[0] + "_обработанный.xlsx"
+    # предыдущий результат этого пользователя больше не нужен
+    _remove_file(_result_path(session.get("last_token")))
+    session["last_token"] = token
+    session["last_name"] = filename.rsplit(".", 1)[0] + "_обработанный.xlsx"
 
     flash(f"Файл успешно обработан. Найдены столбцы: '{before_col}' (до), '{after_col}' (после).")
     return render_template(
         "index.html",
-        preview_html=preview_html,
+        preview=preview,
         download_url=url_for("download_result"),
     )
 
 
 @app.route("/download")
 def download_result():
-    output = app.config.get("LAST_PROCESSED_FILE")
-    name = app.config.get("LAST_PROCESSED_NAME", "result.xlsx")
-    if output is None:
+    # файл не удаляем: его можно скачать повторно, пока не загружен новый
+    output_path = _result_path(session.get("last_token"))
+    name = session.get("last_name", "result.xlsx")
+    if output_path is None or not os.path.exists(output_path):
         flash("Нет обработанного файла. Сначала загрузите и обработайте Excel.")
         return redirect(url_for("index"))
-    output.seek(0)
+
     return send_file(
-        output,
+        output_path,
         as_attachment=True,
         download_name=name,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
@@ -0,0 +1,58 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("numpy")
+pytest.importorskip("flask")
+pytest.importorskip("httpx")
+
+import app as root_app  # noqa: E402
+
+
+def _load_web_app():
+    path = Path(__file__).resolve().parent.parent / "web_app" / "app.py"
+    spec = importlib.util.spec_from_file_location("web_app_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+APPS = [root_app, _load_web_app()]
+
+
+@pytest.mark.parametrize("module", APPS, ids=["app", "web_app"])
+def test_format_intervals_labels(module):
+    minutes = pd.Series([None, -5, 45, 60, 85], dtype="Int64")
+
+    labels = list(module.format_intervals(minutes))
+
+    assert labels == ["", "ошибка", "45 мин", "1 ч", "1 ч 25 мин"]
+
+
+@pytest.mark.parametrize("module", APPS, ids=["app", "web_app"])
+def test_process_dataframe_interval_columns(module):
+    # даты уже в ссылках (saved-...), так что HTTP не нужен
+    df = pd.DataFrame(
+        {
+            "Фото ДО": [
+                "https://example.com/saved-20240101_100000.jpg",
+                "https://example.com/saved-20240101_100000.jpg",
+                None,
+            ],
+            "Фото ПОСЛЕ": [
+                "https://example.com/saved-20240101_112500.jpg",
+                "https://example.com/saved-20240101_090000.jpg",
+                "https://example.com/saved-20240101_090000.jpg",
+            ],
+        }
+    )
+
+    processed, *_ = module.process_dataframe(df)
+
+    assert processed["Интервал_мин"].tolist() == ["1 ч 25 мин", "ошибка", ""]
+    raw = processed["interval_minutes_raw"]
+    assert raw.iloc[0] == 85
+    assert raw.iloc[1] is pd.NA
+    assert raw.iloc[2] is pd.NA
@@ -0,0 +1,101 @@
+import asyncio
+import datetime as dt
+from email.utils import format_datetime
+from functools import partial
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("flask")
+
+import app as root_app  # noqa: E402
+
+PHOTO_URL = "https://photos.test/get-photo-url/45964825/"
+SAVED_URL = "https://photos.test/files/saved-20240101_103000.jpg"
+
+
+@pytest.fixture
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(root_app, "CACHE_PATH", str(tmp_path / "url_cache.sqlite"))
+    monkeypatch.setattr(root_app, "_cache_conn", None)
+    monkeypatch.setattr(root_app, "_cache_pid", None)
+    monkeypatch.setattr(root_app, "_url_datetime_cache", {})
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    real_sleep = asyncio.sleep
+    waits = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        waits.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(root_app.asyncio, "sleep", fake_sleep)
+    return waits
+
+
+def _resolve_one(handler, url=PHOTO_URL):
+    transport = httpx.MockTransport(handler)
+    return asyncio.run(root_app.resolve_all([url], transport=transport))[0]
+
+
+def test_rate_limited_then_ok_returns_date(no_sleep):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        if str(request.url) == SAVED_URL:
+            return httpx.Response(200)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "1"})
+        return httpx.Response(302, headers={"Location": SAVED_URL})
+
+    assert _resolve_one(handler) == dt.datetime(2024, 1, 1, 10, 30, 0)
+    assert no_sleep == [1]
+
+
+def test_server_error_on_every_attempt_is_not_cached(isolated_cache, no_sleep, monkeypatch):
+    transport = httpx.MockTransport(lambda request: httpx.Response(503))
+    monkeypatch.setattr(root_app, "resolve_all", partial(root_app.resolve_all, transport=transport))
+
+    assert _resolve_one(lambda request: httpx.Response(503)) is root_app._TRANSIENT
+
+    root_app.resolve_urls([PHOTO_URL])
+
+    assert PHOTO_URL not in root_app._url_datetime_cache
+    assert root_app.cache_get_many([PHOTO_URL]) == {}
+
+
+def test_not_found_without_date_is_cached_as_none(isolated_cache, monkeypatch):
+    transport = httpx.MockTransport(lambda request: httpx.Response(404))
+    monkeypatch.setattr(root_app, "resolve_all", partial(root_app.resolve_all, transport=transport))
+
+    root_app.resolve_urls([PHOTO_URL])
+
+    assert root_app._url_datetime_cache == {PHOTO_URL: None}
+    assert root_app.cache_get_many([PHOTO_URL]) == {PHOTO_URL: None}
+
+
+def test_date_in_redirected_url_wins_over_error_status(no_sleep):
+    def handler(request):
+        if str(request.url) == SAVED_URL:
+            return httpx.Response(503)
+        return httpx.Response(302, headers={"Location": SAVED_URL})
+
+    assert _resolve_one(handler) == dt.datetime(2024, 1, 1, 10, 30, 0)
+    assert no_sleep == []
+
+
+def test_retry_after_http_date():
+    when = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=10)
+    resp = httpx.Response(429, headers={"Retry-After": format_datetime(when, usegmt=True)})
+
+    assert 8 <= root_app._retry_after_seconds(resp, 0) <= 10
+
+
+def test_retry_after_http_date_in_past_means_no_wait():
+    when = dt.datetime.now(dt.timezone.utc) - dt.timedelta(minutes=5)
+    resp = httpx.Response(429, headers={"Retry-After": format_datetime(when, usegmt=True)})
+
+    assert root_app._retry_after_seconds(resp, 0) == 0
@@ -0,0 +1,29 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+openpyxl = pytest.importorskip("openpyxl")
+pytest.importorskip("xlsxwriter")
+pytest.importorskip("flask")
+pytest.importorskip("httpx")
+
+from app import write_excel_file  # noqa: E402
+
+
+def test_write_excel_file_keeps_rows_beyond_hyperlink_limit(tmp_path):
+    # больше 65 530 ячеек со ссылками — предел гиперссылок на лист в xlsxwriter
+    n_rows = 70_000
+    df = pd.DataFrame(
+        {
+            "Фото ДО": [f"https://example.com/get-photo-url/{i}/" for i in range(n_rows)],
+            "Интервал_мин": ["45 мин"] * n_rows,
+        }
+    )
+    path = tmp_path / "result.xlsx"
+
+    write_excel_file(df, str(path))
+
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    rows = list(workbook.active.iter_rows(values_only=True))
+    workbook.close()
+    assert len(rows) == n_rows + 1
+    assert rows[-1] == (f"https://example.com/get-photo-url/{n_rows - 1}/", "45 мин")
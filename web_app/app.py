@@ -1,61 +1,90 @@
-import io
+from __future__ import annotations
+
+import os
 import re
+import shutil
+import tempfile
 import datetime as dt
-
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash
-import pandas as pd
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from uuid import uuid4
+
+from flask import (
+    Flask,
+    flash,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    url_for,
+)
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# pandas/numpy/xlsxwriter тяжёлые (~100 мс и десятки МБ на воркер), поэтому
+# импортируем их внутри функций — только когда действительно обрабатываем файл
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 app = Flask(__name__)
-app.secret_key = "asu_photo_secret_key"  # для flash-сообщений
+app.secret_key = os.environ.get("SECRET_KEY", "asu_photo_secret_key")  # для flash-сообщений и сессии
+MAX_UPLOAD_MB = 50  # файлы больше не принимаем
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+
+
+_SAVED_RE = re.compile(r"saved-(\d{8})_(\d{6})")
 
 
 def extract_datetime_from_string(s: str):
     """Ищет в строке шаблон saved-YYYYMMDD_HHMMSS и возвращает datetime или None."""
     if not isinstance(s, str):
         return None
-    match = re.search(r"saved-(\d{8})_(\d{6})", s)
+    return _parse_saved(s)
+
+
+@lru_cache(maxsize=65536)
+def _parse_saved(s: str):
+    match = _SAVED_RE.search(s)
     if not match:
         return None
     date_part = match.group(1)  # YYYYMMDD
     time_part = match.group(2)  # HHMMSS
     try:
-        year = int(date_part[0:4])
-        month = int(date_part[4:6])
-        day = int(date_part[6:8])
-        hour = int(time_part[0:2])
-        minute = int(time_part[2:4])
-        second = int(time_part[4:6])
-        return dt.datetime(year, month, day, hour, minute, second)
+        return dt.datetime.strptime(f"{date_part}{time_part}", "%Y%m%d%H%M%S")
     except ValueError:
         return None
 
 
-def format_interval(minutes: int):
-    """minutes -> строка '45 мин' или '1 ч 25 мин' или 'ошибка'."""
-    if minutes is None:
-        return ""
-    if minutes < 0:
-        return "ошибка"
-    if minutes < 60:
-        return f"{minutes} мин"
-    hours = minutes // 60
-    mins = minutes % 60
-    if mins == 0:
-        return f"{hours} ч"
-    return f"{hours} ч {mins} мин"
+def format_intervals(minutes: pd.Series):
+    """Series минут (Int64) -> строки '45 мин' / '1 ч' / '1 ч 25 мин', 'ошибка' или ''."""
+    import numpy as np
+
+    missing = minutes.isna().to_numpy()
+    m = minutes.fillna(0).astype("int64")
+    hours = (m // 60).astype(str)
+    mins = (m % 60).astype(str)
+    return np.select(
+        [missing, (m < 0).to_numpy(), (m < 60).to_numpy(), (m % 60 == 0).to_numpy()],
+        ["", "ошибка", (m.astype(str) + " мин").to_numpy(), (hours + " ч").to_numpy()],
+        default=(hours + " ч " + mins + " мин").to_numpy(),
+    )
 
 
 def detect_photo_columns(df: pd.DataFrame):
     """Находит первые два столбца, содержащие 'saved-'."""
+    import pandas as pd
+
     candidate_cols = []
     for col in df.columns:
         series = df[col]
         if not pd.api.types.is_object_dtype(series):
             continue
-        contains_saved = series.astype(str).str.contains("saved-", na=False)
-        if contains_saved.any():
-            candidate_cols.append(col)
+        # до первого совпадения, без прохода по всему столбцу
+        for value in series:
+            if isinstance(value, str) and "saved-" in value:
+                candidate_cols.append(col)
+                break
         if len(candidate_cols) >= 2:
             break
     if len(candidate_cols) < 2:
@@ -64,45 +93,26 @@ def detect_photo_columns(df: pd.DataFrame):
 
 
 def process_dataframe(df: pd.DataFrame):
-    """Обрабатывает DataFrame и возвращает (df_processed, before_col, after_col, preview_html)."""
+    """Обрабатывает DataFrame и возвращает (df_processed, before_col, after_col, preview, intervals)."""
+    import pandas as pd
+
     before_col, after_col = detect_photo_columns(df)
     if before_col is None or after_col is None:
         raise ValueError("Не найдены два столбца со ссылками на фото (saved-).")
 
-    df = df.copy()
-
-    before_dates = []
-    after_dates = []
-    interval_minutes_raw = []
-    interval_strs = []
-
-    for _, row in df.iterrows():
-        before_val = row.get(before_col)
-        after_val = row.get(after_col)
-
-        dt_before = extract_datetime_from_string(before_val)
-        dt_after = extract_datetime_from_string(after_val)
-
-        before_dates.append(dt_before)
-        after_dates.append(dt_after)
-
-        if dt_before is None or dt_after is None:
-            interval_minutes_raw.append(None)
-            interval_strs.append("")
-        else:
-            delta = dt_after - dt_before
-            minutes = int(delta.total_seconds() // 60)
-            if minutes < 0:
-                interval_minutes_raw.append(None)
-                interval_strs.append("ошибка")
-            else:
-                interval_minutes_raw.append(minutes)
-                interval_strs.append(format_interval(minutes))
-
-    df["Дата_время_до"] = before_dates
-    df["Дата_время_после"] = after_dates
-    df["Интервал_мин"] = interval_strs
-    df["interval_minutes_raw"] = interval_minutes_raw
+    before = pd.to_datetime(df[before_col].map(extract_datetime_from_string))
+    after = pd.to_datetime(df[after_col].map(extract_datetime_from_string))
+    delta_min = ((after - before).dt.total_seconds() // 60).astype("Int64")
+
+    # assign возвращает новый DataFrame, исходный не трогаем и не копируем заранее
+    df = df.assign(
+        **{
+            "Дата_время_до": before,
+            "Дата_время_после": after,
+            "Интервал_мин": format_intervals(delta_min),
+            "interval_minutes_raw": delta_min.where(delta_min >= 0),
+        }
+    )
 
     # Предпросмотр
     cols_to_show = [
@@ -112,31 +122,135 @@ def process_dataframe(df: pd.DataFrame):
         "Дата_время_после",
         "Интервал_мин",
     ]
-    preview_df = df[cols_to_show + ["interval_minutes_raw"]].head(15).copy()
+    head = df.head(15)
+    interval_list = head["interval_minutes_raw"].tolist()
+
+    # Форматируем даты для предпросмотра (служебную колонку в таблицу не берём)
+    preview_df = head[cols_to_show].assign(
+        **{
+            col: head[col].dt.strftime("%Y-%m-%d %H:%M:%S").fillna("")
+            for col in ["Дата_время_до", "Дата_время_после"]
+        }
+    )
 
-    # Форматируем даты для предпросмотра
-    for col in ["Дата_время_до", "Дата_время_после"]:
-        preview_df[col] = preview_df[col].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S") if isinstance(x, dt.datetime) else ""
-        )
+    # Таблицу рисует шаблон, сюда отдаём только заголовки и строки
+    preview = {
+        "columns": cols_to_show,
+        "rows": preview_df.fillna("").to_dict(orient="records"),
+    }
+
+    return df, before_col, after_col, preview, interval_list
 
-    # Отрисуем HTML-таблицу без служебной колонки
-    interval_list = preview_df["interval_minutes_raw"].tolist()
-    preview_df = preview_df.drop(columns=["interval_minutes_raw"])
-    preview_html = preview_df.to_html(
-        classes="table table-striped table-bordered table-sm",
-        index=False,
-        border=0,
-        escape=False,
+
+def read_excel_file(path: str) -> pd.DataFrame:
+    """Читает .xlsx/.xls через calamine (Rust), при ошибке — штатными движками pandas."""
+    import pandas as pd
+
+    try:
+        return pd.read_excel(path, engine="calamine")
+    except Exception:
+        if path.endswith(".xlsx"):
+            return pd.read_excel(path, engine="openpyxl")
+        return pd.read_excel(path)
+
+
+def write_excel_file(df: pd.DataFrame, path: str):
+    """Пишет DataFrame в .xlsx построчно в режиме constant_memory.
+
+    В этом режиме xlsxwriter сбрасывает каждую строку на диск сразу после записи,
+    но принимает строки только по порядку. pandas пишет ячейки по столбцам,
+    поэтому df.to_excel тут не подходит — строки пишем сами.
+    """
+    import pandas as pd
+    import xlsxwriter
+
+    def excel_value(value):
+        # приводим значение ячейки pandas к типу, который понимает xlsxwriter
+        if pd.api.types.is_scalar(value) and pd.isna(value):
+            return None
+        if isinstance(value, pd.Timestamp):
+            return value.to_pydatetime()
+        if hasattr(value, "item"):  # numpy-скаляры
+            return value.item()
+        return value
+
+    workbook = xlsxwriter.Workbook(
+        path,
+        {
+            "constant_memory": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+            # ссылки пишем обычным текстом: в листе допустимо не больше 65 530
+            # гиперссылок, остальные ячейки xlsxwriter молча пропускает
+            "strings_to_urls": False,
+        },
     )
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, [str(c) for c in df.columns])
+        for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_idx, 0, [excel_value(v) for v in row])
+    finally:
+        workbook.close()
 
-    return df, before_col, after_col, preview_html, interval_list
+
+# обработанные файлы лежат во временной папке как asu_<token>.xlsx;
+# в сессии хранится только token, путь всегда собираем на сервере
+_RESULT_TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+_RESULT_NAME_RE = re.compile(r"^asu_[0-9a-f]{32}\.xlsx$")
+RESULT_MAX_AGE = 24 * 60 * 60  # сек; результаты старше суток удаляем
+
+
+def _result_path(token):
+    """Путь к результату по token из сессии или None, если token некорректный."""
+    if not isinstance(token, str) or not _RESULT_TOKEN_RE.match(token):
+        return None
+    return os.path.join(tempfile.gettempdir(), f"asu_{token}.xlsx")
+
+
+def _remove_file(path):
+    """Удаляет временный файл, если он ещё существует."""
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _cleanup_old_results():
+    """Удаляет результаты, которые так и не скачали за RESULT_MAX_AGE."""
+    tmp_dir = tempfile.gettempdir()
+    now = dt.datetime.now().timestamp()
+    for name in os.listdir(tmp_dir):
+        if not _RESULT_NAME_RE.match(name):
+            continue
+        path = os.path.join(tmp_dir, name)
+        try:
+            if now - os.path.getmtime(path) > RESULT_MAX_AGE:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(_exc):
+    flash(f"Файл слишком большой (максимум {MAX_UPLOAD_MB} МБ).")
+    return redirect(url_for("index"))
+
+
+@lru_cache(maxsize=1)
+def _render_empty_index():
+    """Пустая форма одинакова для всех, поэтому рендерим её один раз."""
+    return render_template("index.html", preview=None, download_url=None)
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "GET":
-        return render_template("index.html", preview_html=None, download_url=None)
+        # с flash-сообщениями и в debug (шаблон может меняться) рендерим заново
+        if "_flashes" in session or app.debug:
+            return render_template("index.html", preview=None, download_url=None)
+        return _render_empty_index()
 
     # POST: загрузка и обработка файла
     uploaded = request.files.get("file")
@@ -149,53 +263,53 @@ def index():
         flash("Поддерживаются только файлы .xlsx и .xls")
         return redirect(url_for("index"))
 
-    try:
-        # Читаем Excel из памяти
-        file_bytes = uploaded.read()
-        buffer = io.BytesIO(file_bytes)
-
-        if filename.lower().endswith(".xlsx"):
-            df = pd.read_excel(buffer, engine="openpyxl")
-        else:
-            df = pd.read_excel(buffer)
+    # Пишем загрузку во временный файл кусками, не держа её целиком в памяти
+    suffix = "." + filename.rsplit(".", 1)[-1].lower()
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        shutil.copyfileobj(uploaded.stream, tmp, 1 << 20)
+        upload_path = tmp.name
 
-        df_processed, before_col, after_col, preview_html, _intervals = process_dataframe(
+    try:
+        df = read_excel_file(upload_path)
+        df_processed, before_col, after_col, preview, _intervals = process_dataframe(
             df
         )
     except Exception as exc:
         flash(f"Ошибка обработки файла: {exc}")
         return redirect(url_for("index"))
+    finally:
+        os.unlink(upload_path)
 
-    # Сохраняем обработанный файл в сессию как байты (в реальном проде — в хранилище)
-    output = io.BytesIO()
-    df_to_save = df_processed.copy()
-    if "interval_minutes_raw" in df_to_save.columns:
-        df_to_save = df_to_save.drop(columns=["interval_minutes_raw"])
-    df_to_save.to_excel(output, index=False, engine="openpyxl")
-    output.seek(0)
+    # Сохраняем обработанный файл во временную папку, token — в сессию пользователя
+    _cleanup_old_results()
+    df_to_save = df_processed.drop(columns=["interval_minutes_raw"], errors="ignore")
+    token = uuid4().hex
+    write_excel_file(df_to_save, _result_path(token))
 
-    # Кладём в глобальный dict по простому ключу (один пользователь за раз)
-    app.config["LAST_PROCESSED_FILE"] = output
-    app.config["LAST_PROCESSED_NAME"] = filename.rsplit(".", 1)[0] + "_обработанный.xlsx"
+    # предыдущий результат этого пользователя больше не нужен
+    _remove_file(_result_path(session.get("last_token")))
+    session["last_token"] = token
+    session["last_name"] = filename.rsplit(".", 1)[0] + "_обработанный.xlsx"
 
     flash(f"Файл успешно обработан. Найдены столбцы: '{before_col}' (до), '{after_col}' (после).")
     return render_template(
         "index.html",
-        preview_html=preview_html,
+        preview=preview,
         download_url=url_for("download_result"),
     )
 
 
 @app.route("/download")
 def download_result():
-    output = app.config.get("LAST_PROCESSED_FILE")
-    name = app.config.get("LAST_PROCESSED_NAME", "result.xlsx")
-    if output is None:
+    # файл не удаляем: его можно скачать повторно, пока не загружен новый
+    output_path = _result_path(session.get("last_token"))
+    name = session.get("last_name", "result.xlsx")
+    if output_path is None or not os.path.exists(output_path):
         flash("Нет обработанного файла. Сначала загрузите и обработайте Excel.")
         return redirect(url_for("index"))
-    output.seek(0)
+
     return send_file(
-        output,
+        output_path,
         as_attachment=True,
         download_name=name,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",